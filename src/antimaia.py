@@ -1,14 +1,36 @@
 import asyncio
+from collections import OrderedDict
+import contextlib
+import functools
+import os
 from pathlib import Path
+import re
 import subprocess
 import chess
 import chess.engine
 import chess.pgn
+import chess.polyglot
 from subprocess import PIPE, DEVNULL
-from stockfish import Stockfish
 import numpy as np
 from datetime import datetime
 
+class LRUCache(OrderedDict):
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        if len(self) > self.max_size:
+            del self[next(iter(self))]
+
 class Player:
     def __init__(self, name):
         self.name = name
@@ -16,18 +38,27 @@ class Player:
     async def move(self, board):
         raise NotImplementedError('classes must inherit from base class')
 
+    async def close(self):
+        pass
+
 class MaiaPlayer(Player):
+    # lc0 verbose move stats, e.g. "e2e4  (322 ) N:  0 (+ 0) (P: 12.34%) ..."
+    _INFO_RE = re.compile(r'^\s*(\S+?)\s+\(.*?P:\s*([-\d.]+)%')
+
     def __init__(self, name, weights_path, parallel=False):
         super().__init__(name)
         self.weights_path = weights_path
         self.lc0Path = '/usr/local/bin/lc0'
         self.engine = None
+        self.transport = None
+        self._engine_lock = None
+        self._engine_loop = None
         self.parallel = parallel
         self.limit = chess.engine.Limit(depth=0)
+        self._rng = np.random.default_rng()
 
-    async def move(self, fen):
-        board = chess.Board(fen)
-
+    async def move(self, board):
+        fen = board.fen()
         if self.parallel:
             fen, distribution = await self._get_maia_distribution_async(fen)
         else:
@@ -37,80 +68,140 @@ class MaiaPlayer(Player):
             return None
 
         sample = True   # sample from the move distribution
-        move = ''
+        move = None
         if not sample:
             move = distribution[0][0]
         else:
-            moves, probs = zip(*distribution)
-            norm = sum(probs)
-            move = np.random.choice(moves, p=[x/norm for x in probs])
-        return chess.Move.from_uci(move)
+            n = len(distribution)
+            probs = np.fromiter((pct for _, pct in distribution), dtype=np.float64, count=n)
+            probs /= probs.sum()
+            move = distribution[self._rng.choice(n, p=probs)][0]
+        return move
 
     def _parse_info(self, s):
-        s = ''.join(s.split(' '))
-        move = s.split('(')[0]
-        pct = float(s.split('P:')[1].split('%')[0]) / 100
-        return move, pct
-
-    async def _call_maia_parallel(self, fens):
-        fens = set(fens)
-        distributions = await asyncio.gather(*[self._get_maia_distribution_async(fen) for fen in fens])
-        return {fen: distribution for fen, distribution in distributions}
+        m = self._INFO_RE.match(s)
+        if m is None or m.group(1) == 'node':
+            return None
+        return chess.Move.from_uci(m.group(1)), float(m.group(2)) / 100
+
+    async def _stream_maia_parallel(self, fens):
+        async def distribution(key, fen):
+            f, dist = await self._get_maia_distribution_async(fen)
+            return key, dist
+
+        # yield each distribution as soon as it is ready, the rest are cancelled if the caller stops early
+        tasks = [asyncio.create_task(distribution(key, fen)) for key, fen in fens.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
 
     def _call_maia(self, fens):
         distributions = {}
-        for fen in fens:
+        for key, fen in fens.items():
             f, dist = self._get_maia_distribution(fen)
-            distributions[fen] = dist
+            distributions[key] = dist
         return distributions
 
+    def _lc0_command(self):
+        return [self.lc0Path, f'--weights={self.weights_path}', '--verbose-move-stats']
+
+    def _get_engine(self):
+        # a single lc0 process is kept alive and reused for every position
+        if self.engine is None:
+            self.engine = chess.engine.SimpleEngine.popen_uci(
+                self._lc0_command(), stderr=DEVNULL, stdout=PIPE)
+        return self.engine
+
+    def _get_engine_lock(self):
+        loop = asyncio.get_running_loop()
+        if self._engine_loop is not loop:
+            # the async engine and its lock belong to the event loop that created them
+            self._engine_loop = loop
+            self._engine_lock = asyncio.Lock()
+            if self.transport is not None:
+                self.engine = None
+                self.transport = None
+        return self._engine_lock
+
+    async def _get_engine_async(self):
+        if self.engine is None:
+            self.transport, self.engine = await chess.engine.popen_uci(
+                self._lc0_command(), stderr=DEVNULL, stdout=PIPE)
+        return self.engine
+
     def _get_maia_distribution(self, fen):
-        engine = chess.engine.SimpleEngine.popen_uci(
-            [self.lc0Path, f'--weights={self.weights_path}', '--verbose-move-stats'],
-            stderr=DEVNULL, stdout=PIPE)
+        engine = self._get_engine()
 
         infos = []
         with engine.analysis(chess.Board(fen), self.limit) as analysis:
             for info in analysis:
                 if 'string' in info:
-                    move, pct = self._parse_info(info['string'])
-                    if move != 'node':
-                        infos.append((move, pct))
+                    parsed = self._parse_info(info['string'])
+                    if parsed:
+                        infos.append(parsed)
 
-        engine.quit()
         return [fen, sorted(infos, key=lambda x: x[1], reverse=True)]
 
     async def _get_maia_distribution_async(self, fen):
-        transport, engine = await chess.engine.popen_uci(
-                [self.lc0Path, f'--weights={self.weights_path}', '--verbose-move-stats'],
-                stderr=DEVNULL, stdout=PIPE)
-
         infos = []
-        with await engine.analysis(chess.Board(fen), self.limit) as analysis:
-            async for info in analysis:
-                if 'string' in info:
-                    move, pct = self._parse_info(info['string'])
-                    if move != 'node':
-                        infos.append((move, pct))
-        engine.quit()
+        # the engine handles one command at a time, a new one would cancel the running analysis
+        async with self._get_engine_lock():
+            engine = await self._get_engine_async()
+            with await engine.analysis(chess.Board(fen), self.limit) as analysis:
+                async for info in analysis:
+                    if 'string' in info:
+                        parsed = self._parse_info(info['string'])
+                        if parsed:
+                            infos.append(parsed)
         return [fen, sorted(infos, key=lambda x: x[1], reverse=True)]
 
+    async def close(self):
+        if self.engine is None:
+            return
+        if self.transport is None:
+            self.engine.quit()
+        elif self._engine_loop is asyncio.get_running_loop():
+            # an engine started on another event loop can't be shut down from this one, it is just dropped
+            await self.engine.quit()
+        self.engine = None
+        self.transport = None
+        self._engine_lock = None
+        self._engine_loop = None
+
 class AntimaiaPlayer(MaiaPlayer):
-    def __init__(self, name, weights_path, stockfish_depth, parallel=False):
+    def __init__(self, name, weights_path, stockfish_depth, parallel=False, stockfish_workers=None, prune=False):
         super().__init__(name, weights_path, parallel)
         self.weights_path = weights_path
         self.stockfish_depth = stockfish_depth
-        self.stockfish = Stockfish(
-            path='/usr/local/bin/stockfish',
-            depth=stockfish_depth,
-            parameters={"Threads": 2, "Hash": 32})
+        self.stockfishPath = '/usr/local/bin/stockfish'
+        self.stockfish_limit = chess.engine.Limit(depth=stockfish_depth)
+        self.stockfish = None
         self.checkmate_weight = 10 * 100      # value in centipawns
+        # with prune=True evaluations are clipped to +/- max_eval so root moves that can't win are cut off early.
+        # this changes which move is picked, the published games were played with prune=False
+        self.prune = prune
+        self.max_eval = 2 * self.checkmate_weight
         self.parallel = parallel
+        self.stockfish_workers = stockfish_workers or os.cpu_count() or 1
+        self._sf_loop = None
+        self._sf_lock = None
+        self._sf_queue = None
+        self._sf_workers = None
+        self._sf_pending = {}     # zobrist hash -> future of an evaluation queued on the pool
+        self.max_cache_size = 200_000
+        # zobrist hash -> maia distribution / stockfish evaluation, kept across moves
+        self._maia_cache = LRUCache(self.max_cache_size)
+        self._sf_cache = LRUCache(self.max_cache_size)
+        # zobrist hash of a root position -> best move found the last time it was searched
+        self._killer = LRUCache(self.max_cache_size)
 
-    async def move(self, fen):
-        return await self._get_antimaia_move(fen)
+    async def move(self, board):
+        return await self._get_antimaia_move(board)
 
-    async def _get_antimaia_move(self, fen):
+    async def _get_antimaia_move(self, board):
         def ideal_move(mate, val, white):
             if not mate:
                 return False
@@ -120,68 +211,143 @@ class AntimaiaPlayer(MaiaPlayer):
                 return True
             return False
 
-        start_fen = fen
-        board = chess.Board(start_fen)
+        start_fen = board.fen()
         white = board.turn
         moves = list(board.legal_moves)
         best_move = moves[0]
         best_score = float('inf') if not white else -float('inf')
 
-        # if stockfish sees mate, play it
-        val, mate = self._get_stockfish_eval(fen)
+        # if stockfish sees mate, play it. the root is usually a reply already scored two plies ago
+        root_key = chess.polyglot.zobrist_hash(board)
+        if root_key in self._sf_cache:
+            val, mate = self._sf_cache[root_key]
+        else:
+            val, mate = (await self._evaluate_stockfish({root_key: start_fen}))[root_key]
         if ideal_move(mate, val, white):
-            self.stockfish.set_fen_position(start_fen)
-            return chess.Move.from_uci(self.stockfish.get_best_move())
-
-        # gather all fens to evaluate with Maia and call Maia in parallel
-        maia_fens = set()
-        stockfish_fens = set()
-        for move in moves:
-            _board = chess.Board(start_fen)
-            _board.push(move)
-            _fen = _board.fen()
-            maia_fens.add(_fen)
-            stockfish_fens.add(_fen)
+            return await self._get_stockfish_move(start_fen)
 
+        # gather all positions to evaluate with Maia and Stockfish, keyed by zobrist hash
+        child_keys = {}
         maia_distributions = {}
-        if self.parallel:
-            asyncio.set_event_loop(asyncio.new_event_loop())
-            maia_distributions = await asyncio.gather(self._call_maia_parallel(maia_fens))
-            maia_distributions = maia_distributions[0]
-        else:
-            maia_distributions = self._call_maia(maia_fens)
-
-        # gather all fens to evaluate with Stockfish and call Stockfish in parallel
-        for fen, dist in maia_distributions.items():
-            stockfish_fens.add(fen)
-            for mv, pct in dist:
-                _board = chess.Board(fen)
-                _board.push(chess.Move.from_uci(mv))
-                stockfish_fens.add(_board.fen())
-
         stockfish_evals = {}
-        for fen in stockfish_fens:
-            stockfish_evals[fen] = self._get_stockfish_eval(fen)
-
+        maia_fens = {}
+        stockfish_fens = {}
         for move in moves:
-            board.set_fen(start_fen)
             board.push(move)
-            val, mate = stockfish_evals[board.fen()]
-
+            key = chess.polyglot.zobrist_hash(board)
+            child_keys[move] = key
+            # skip positions already seen on previous moves
+            if key in self._maia_cache:
+                maia_distributions[key] = self._maia_cache[key]
+            else:
+                maia_fens[key] = board.fen()
+            if key in self._sf_cache:
+                stockfish_evals[key] = self._sf_cache[key]
+            else:
+                stockfish_fens[key] = board.fen()
+            board.pop()
+
+        batch_size = self.stockfish_workers if self.parallel else 1
+
+        # Maia doesn't need the stockfish evaluations of the children, so both run at once
+        if self.parallel:
+            child_moves = {key: move for move, key in child_keys.items()}
+            prefetched = {}
+            maia_task = asyncio.create_task(
+                self._call_maia_prefetching(board.copy(stack=False), maia_fens, child_moves,
+                                            batch_size if self.prune else None, prefetched))
+        try:
+            stockfish_evals.update(await self._evaluate_stockfish(stockfish_fens))
+        except BaseException:
+            if self.parallel:
+                maia_task.cancel()
+            raise
+
+        # play a move that leads to mate without waiting for Maia
+        for move in moves:
+            val, mate = stockfish_evals[child_keys[move]]
             if ideal_move(mate, val, white):
+                if self.parallel:
+                    maia_task.cancel()
+                    # drop prefetched replies still queued so they don't hold up the next move
+                    for future in prefetched.values():
+                        future.cancel()
                 return move
 
-            distribution = maia_distributions[board.fen()]
-            skip = False
-            move_results = []
-
-            for mv, pct in distribution:
-                _board = board.copy()
-                _board.push(chess.Move.from_uci(mv))
-                val, mate = stockfish_evals[_board.fen()]
-                move_results.append(val * pct)
+        if self.parallel:
+            new_distributions = await maia_task
+        else:
+            new_distributions = self._call_maia(maia_fens)
+
+        for key, dist in new_distributions.items():
+            self._maia_cache[key] = dist
+            maia_distributions[key] = dist
+
+        # try the strongest moves first so weaker ones can be cut off early,
+        # starting with the move picked the last time this position came up
+        if self.prune:
+            moves.sort(key=lambda move: stockfish_evals[child_keys[move]][0], reverse=white)
+            if root_key in self._killer and self._killer[root_key] in moves:
+                moves.remove(self._killer[root_key])
+                moves.insert(0, self._killer[root_key])
+        elif self.parallel:
+            # without pruning every reply is scored, so queue them all at once to keep the pool busy
+            reply_fens = {}
+            for move in moves:
+                board.push(move)
+                for mv, pct in maia_distributions[child_keys[move]]:
+                    board.push(mv)
+                    key = chess.polyglot.zobrist_hash(board)
+                    if key not in self._sf_cache:
+                        reply_fens[key] = board.fen()
+                    board.pop()
+                board.pop()
+            await self._submit_stockfish(reply_fens)
 
-            score = sum(move_results)
+        for move in moves:
+            board.push(move)
+            distribution = maia_distributions[child_keys[move]]
+            pcts = np.fromiter((pct for _, pct in distribution), dtype=np.float64, count=len(distribution))
+            remaining = pcts.sum()
+            score = 0
+            pruned = False
+            step = batch_size if self.prune else max(len(distribution), 1)
+
+            # replies are sorted by probability, when pruning stop once the unexplored ones can't make this the best move.
+            # stockfish only evaluates the replies that are reached, a batch at a time to keep the pool busy
+            for start in range(0, len(distribution), step):
+                batch = distribution[start:start + step]
+                batch_keys = []
+                pending = {}
+                for mv, pct in batch:
+                    board.push(mv)
+                    key = chess.polyglot.zobrist_hash(board)
+                    batch_keys.append(key)
+                    if key in self._sf_cache:
+                        stockfish_evals[key] = self._sf_cache[key]
+                    else:
+                        pending[key] = board.fen()
+                    board.pop()
+                stockfish_evals.update(await self._evaluate_stockfish(pending))
+
+                vals = np.fromiter((stockfish_evals[key][0] for key in batch_keys),
+                                   dtype=np.float64, count=len(batch_keys))
+                batch_pcts = pcts[start:start + step]
+                if self.prune:
+                    vals = np.clip(vals, -self.max_eval, self.max_eval)
+                score += float(vals @ batch_pcts)
+                remaining -= batch_pcts.sum()
+
+                if self.prune and white and score + remaining * self.max_eval <= best_score:
+                    pruned = True
+                    break
+                if self.prune and not white and score - remaining * self.max_eval >= best_score:
+                    pruned = True
+                    break
+
+            board.pop()
+            if pruned:
+                continue
 
             if white and score > best_score:
                 best_score = score
@@ -189,28 +355,190 @@ class AntimaiaPlayer(MaiaPlayer):
             elif not white and score < best_score:
                 best_score = score
                 best_move = move
+
+        if self.prune:
+            self._killer[root_key] = best_move
         return best_move
 
+    async def _call_maia_prefetching(self, board, fens, child_moves, prefetch_size, prefetched):
+        distributions = {}
+        async for key, dist in self._stream_maia_parallel(fens):
+            distributions[key] = dist
+            self._maia_cache[key] = dist
+
+            # the first batch of replies to every root move is always scored (all of them without pruning),
+            # so start on it right away
+            reply_fens = {}
+            board.push(child_moves[key])
+            for mv, pct in dist[:prefetch_size]:
+                board.push(mv)
+                reply_key = chess.polyglot.zobrist_hash(board)
+                if reply_key not in self._sf_cache:
+                    reply_fens[reply_key] = board.fen()
+                board.pop()
+            board.pop()
+            prefetched.update(await self._submit_stockfish(reply_fens))
+        return distributions
+
+    async def _evaluate_stockfish(self, fens):
+        if not fens:
+            return {}
+        if self.parallel:
+            futures = await self._submit_stockfish(fens)
+            return {key: await future for key, future in futures.items()}
+
+        evals = self._call_stockfish(fens)
+        for key, evaluation in evals.items():
+            self._sf_cache[key] = evaluation
+        return evals
+
+    def _get_stockfish(self):
+        # no ucinewgame is sent between positions, so the hash table carries over between siblings
+        if self.stockfish is None:
+            self.stockfish = chess.engine.SimpleEngine.popen_uci(self.stockfishPath)
+            self.stockfish.configure({"Threads": 1, "Hash": 128})
+        return self.stockfish
+
+    async def _get_stockfish_queue(self):
+        loop = asyncio.get_running_loop()
+        if self._sf_loop is not loop:
+            # the queue, workers and pending futures belong to the event loop that created them
+            self._sf_loop = loop
+            self._sf_lock = asyncio.Lock()
+            self._sf_queue = None
+            self._sf_workers = None
+            self._sf_pending = {}
+
+        async with self._sf_lock:
+            if self._sf_queue is None:
+                # start every engine before handing out the queue so startup errors reach the caller
+                engines = []
+                try:
+                    for _ in range(self.stockfish_workers):
+                        transport, engine = await chess.engine.popen_uci(self.stockfishPath)
+                        engines.append(engine)
+                        await engine.configure({"Threads": 1, "Hash": 16})
+                except Exception:
+                    for engine in engines:
+                        with contextlib.suppress(chess.engine.EngineError):
+                            await engine.quit()
+                    raise
+                queue = asyncio.Queue()
+                self._sf_workers = [asyncio.create_task(self._stockfish_worker(engine, queue))
+                                    for engine in engines]
+                self._sf_queue = queue
+        return self._sf_queue
+
+    async def _stockfish_worker(self, engine, queue):
+        # one search thread per worker, parallelism comes from running the workers side by side
+        try:
+            while True:
+                job, future = await queue.get()
+                if future.done():
+                    continue
+                try:
+                    result = await job(engine)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            with contextlib.suppress(chess.engine.EngineError):
+                await engine.quit()
+
+    async def _analyse_job(self, fen, engine):
+        info = await engine.analyse(chess.Board(fen), self.stockfish_limit, info=chess.engine.INFO_SCORE)
+        return self._score_to_eval(info['score'])
+
+    async def _play_job(self, fen, engine):
+        result = await engine.play(chess.Board(fen), self.stockfish_limit)
+        return result.move
+
+    async def _get_stockfish_move(self, fen):
+        if self.parallel:
+            queue = await self._get_stockfish_queue()
+            future = asyncio.get_running_loop().create_future()
+            queue.put_nowait((functools.partial(self._play_job, fen), future))
+            return await future
+        return self._get_stockfish().play(chess.Board(fen), self.stockfish_limit).move
+
+    async def _submit_stockfish(self, fens):
+        # positions already queued share the pending future instead of being evaluated twice
+        queue = await self._get_stockfish_queue()
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for key, fen in fens.items():
+            if key not in self._sf_pending:
+                future = loop.create_future()
+                future.add_done_callback(functools.partial(self._stockfish_done, key))
+                self._sf_pending[key] = future
+                queue.put_nowait((functools.partial(self._analyse_job, fen), future))
+            futures[key] = self._sf_pending[key]
+        return futures
+
+    def _stockfish_done(self, key, future):
+        if self._sf_pending.get(key) is future:
+            del self._sf_pending[key]
+        if not future.cancelled() and future.exception() is None:
+            self._sf_cache[key] = future.result()
+
+    def _call_stockfish(self, fens):
+        return {key: self._get_stockfish_eval(fen) for key, fen in fens.items()}
+
     def _get_stockfish_eval(self, fen):
-        self.stockfish.set_fen_position(fen)
-        evaluation = self.stockfish.get_evaluation()
-        if evaluation['type'] == 'mate':
-            return evaluation['value'] * self.checkmate_weight, True
+        info = self._get_stockfish().analyse(chess.Board(fen), self.stockfish_limit, info=chess.engine.INFO_SCORE)
+        return self._score_to_eval(info['score'])
+
+    def _score_to_eval(self, score):
+        score = score.white()
+        if score.is_mate():
+            return score.mate() * self.checkmate_weight, True
         else:
-            return evaluation['value'], False
+            return score.score(), False
+
+    async def close(self):
+        await super().close()
+        if self.stockfish is not None:
+            self.stockfish.quit()
+            self.stockfish = None
+        # a pool started on another event loop can't be shut down from this one, it is just dropped
+        if self._sf_loop is asyncio.get_running_loop():
+            for future in list(self._sf_pending.values()):
+                future.cancel()
+            if self._sf_workers is not None:
+                for worker in self._sf_workers:
+                    worker.cancel()
+                await asyncio.gather(*self._sf_workers, return_exceptions=True)
+        self._sf_loop = None
+        self._sf_lock = None
+        self._sf_queue = None
+        self._sf_workers = None
+        self._sf_pending = {}
 
 class StockfishPlayer(Player):
     def __init__(self, name, depth):
         super().__init__(name)
         self.depth = depth
-        self.stockfish = Stockfish(
-            path='/usr/local/bin/stockfish',
-            depth=self.depth,
-            parameters={"Threads": 2, "Hash": 32})
+        self.limit = chess.engine.Limit(depth=self.depth)
+        self.stockfish = None
+
+    def _get_stockfish(self):
+        if self.stockfish is None:
+            self.stockfish = chess.engine.SimpleEngine.popen_uci('/usr/local/bin/stockfish')
+            self.stockfish.configure({"Threads": 2, "Hash": 32})
+        return self.stockfish
 
-    async def move(self, fen):
-        self.stockfish.set_fen_position(fen)
-        return chess.Move.from_uci(self.stockfish.get_best_move())
+    async def move(self, board):
+        # every move is searched as a fresh game from the FEN alone (ucinewgame, no move history),
+        # the same way the published games were played
+        return self._get_stockfish().play(chess.Board(board.fen()), self.limit, game=object()).move
+
+    async def close(self):
+        if self.stockfish is not None:
+            self.stockfish.quit()
+            self.stockfish = None
 
 class GameManager:
     def __init__(self, white_player, black_player, verbose=False, round=None):
@@ -223,26 +551,31 @@ class GameManager:
         board = chess.Board()
         move_count = 1
 
-        while not board.is_game_over():
-            w = await self.white.move(board.fen())
-            board.push(w)
-
-            if not w or board.is_game_over():
-                if self.verbose:
-                    print(f'{move_count}. {w}')
-                break
+        try:
+            while not board.is_game_over():
+                w = await self.white.move(board.copy())
+                board.push(w)
 
-            b = await self.black.move(board.fen())
-            board.push(b)
+                if not w or board.is_game_over():
+                    if self.verbose:
+                        print(f'{move_count}. {w}')
+                    break
 
-            if self.verbose:
-                print(f'{move_count}. {w} {b}')
+                b = await self.black.move(board.copy())
+                board.push(b)
 
-            if not b or board.is_game_over():
                 if self.verbose:
                     print(f'{move_count}. {w} {b}')
-                break
-            move_count += 1
+
+                if not b or board.is_game_over():
+                    if self.verbose:
+                        print(f'{move_count}. {w} {b}')
+                    break
+                move_count += 1
+        finally:
+            await self.white.close()
+            await self.black.close()
+
         game = chess.pgn.Game.from_board(board)
         game.headers['White'] = self.white.name
         game.headers['Black'] = self.black.name